@@ -0,0 +1,33 @@
+"""パックファイルで扱う要素型の定義"""
+import numpy
+
+
+_TYPE_TO_CODE_DICT = {
+    numpy.int8: 0, numpy.int16: 1, numpy.int32: 2, numpy.int64: 3,
+    numpy.uint8: 4, numpy.uint16: 5, numpy.uint32: 6, numpy.uint64: 7,
+    numpy.float16: 8, numpy.float32: 9, numpy.float64: 10,
+    numpy.bool_: 11
+}
+
+_CODE_TO_TYPE = (
+    numpy.int8, numpy.int16, numpy.int32, numpy.int64,
+    numpy.uint8, numpy.uint16, numpy.uint32, numpy.uint64,
+    numpy.float16, numpy.float32, numpy.float64,
+    numpy.bool_
+)
+
+_TYPE_TO_NBYTES_DICT = {
+    numpy.int8: 1, numpy.int16: 2, numpy.int32: 4, numpy.int64: 8,
+    numpy.uint8: 1, numpy.uint16: 2, numpy.uint32: 4, numpy.uint64: 8,
+    numpy.float16: 2, numpy.float32: 4, numpy.float64: 8,
+    numpy.bool_: 1
+}
+
+_ACCEPTABLE_DATA_TYPES = frozenset([
+    numpy.int8, numpy.uint8,
+    numpy.int16, numpy.uint16,
+    numpy.int32, numpy.uint32,
+    numpy.int64, numpy.uint64,
+    numpy.float16, numpy.float32, numpy.float64,
+    numpy.bool_
+])
@@ -4,140 +4,327 @@
 ランダムアクセスで読み込んでくるための機能を提供するモジュールです。
 """
 import os
+import collections
+import concurrent.futures
+import math
+import mmap
+import shutil
 import struct
+import tempfile
+import warnings
 import numpy
+from ._types import _TYPE_TO_CODE_DICT
+from ._types import _CODE_TO_TYPE
+from ._types import _TYPE_TO_NBYTES_DICT
+from ._types import _ACCEPTABLE_DATA_TYPES
 
 
-_TYPE_TO_CODE_DICT = {
-    numpy.int8: 0, numpy.int16: 1, numpy.int32: 2, numpy.int64: 3,
-    numpy.uint8: 4, numpy.uint16: 5, numpy.uint32: 6, numpy.uint64: 7,
-    numpy.float16: 8, numpy.float32: 9, numpy.float64: 10,
-    numpy.bool_: 11
-}
+_WRITE_BUFFER_SIZE = 8 * 1024 * 1024
 
-_CODE_TO_TYPE_DICT = {
-    0: numpy.int8, 1: numpy.int16, 2: numpy.int32, 3: numpy.int64,
-    4: numpy.uint8, 5: numpy.uint16, 6: numpy.uint32, 7: numpy.uint64,
-    8: numpy.float16, 9: numpy.float32, 10: numpy.float64,
-    11: numpy.bool_
-}
+_HEADER_STRUCT = struct.Struct('IHH')
+_DATA_HEADER_STRUCT = struct.Struct('HH')
+_TOTAL_COUNT_STRUCT = struct.Struct('I')
+_QUANTIZATION_STRUCT = struct.Struct('dH')
 
-_TYPE_TO_NBYTES_DICT = {
-    numpy.int8: 1, numpy.int16: 2, numpy.int32: 4, numpy.int64: 8,
-    numpy.uint8: 1, numpy.uint16: 2, numpy.uint32: 4, numpy.uint64: 8,
-    numpy.float16: 2, numpy.float32: 4, numpy.float64: 8,
-    numpy.bool_: 1
-}
+_MAX_NUM_COLUMNS = 0xFFFF
+_LAYOUT_CODE_MASK = 0x00FF
+_QUANTIZATION_FLAG = 0x0100
 
+_LAYOUT_TO_CODE_DICT = {
+    'record': 0,
+    'column': 1
+}
 
-_TYPE_TO_STRUCT_FORMAT = {
-    numpy.int8: 'b', numpy.int16: 'h', numpy.int32: 'i', numpy.int64: 'q',
-    numpy.uint8: 'B', numpy.uint16: 'H', numpy.uint32: 'I', numpy.uint64: 'Q',
-    numpy.float16: 'e', numpy.float32: 'f', numpy.float64: 'd',
-    numpy.bool_: '?'
+_ACCESS_PATTERN_TO_MADVISE_NAME = {
+    'random': 'MADV_RANDOM',
+    'sequential': 'MADV_SEQUENTIAL'
 }
 
-_ACCEPTABLE_DATA_TYPES = [
-    numpy.ndarray,
-    numpy.int8, numpy.uint8,
-    numpy.int16, numpy.uint16,
-    numpy.int32, numpy.uint32,
-    numpy.int64, numpy.uint64,
-    numpy.float16, numpy.float32, numpy.float64,
-    numpy.bool_
-]
+
+def _is_acceptable_datum(datum):
+    if isinstance(datum, numpy.ndarray):
+        return datum.dtype.type in _TYPE_TO_CODE_DICT
+    return type(datum) in _ACCEPTABLE_DATA_TYPES
 
 
 def _make_data_header(datum_sample):
-    if type(datum_sample) not in _ACCEPTABLE_DATA_TYPES:
+    if not _is_acceptable_datum(datum_sample):
         return None
     element_type_code = _TYPE_TO_CODE_DICT[datum_sample.dtype.type]
-    if type(datum_sample) == numpy.ndarray:
+    if isinstance(datum_sample, numpy.ndarray):
         dim = len(datum_sample.shape)
         shape = datum_sample.shape
     else:
         dim = 1
         shape = (1,)
-    data_format = f'HH{dim}I'
-    return struct.pack(data_format, element_type_code, dim, *shape)
+    shape_format = f'{dim}I'
+    return _DATA_HEADER_STRUCT.pack(element_type_code, dim) + struct.pack(shape_format, *shape)
 
 
-def _read_data_header(fp):
-    element_type_code, dim = struct.unpack('HH', fp.read(4))
-    element_type = _CODE_TO_TYPE_DICT[element_type_code]
+def _read_data_header(buffer, offset):
+    element_type_code, dim = _DATA_HEADER_STRUCT.unpack_from(buffer, offset)
+    offset += _DATA_HEADER_STRUCT.size
+    element_type = _CODE_TO_TYPE[element_type_code]
     shape_format = f'{dim}I'
-    shape = tuple(struct.unpack(shape_format, fp.read(dim * 4)))
-    return {'element_type': element_type, 'shape': shape}
+    shape = struct.unpack_from(shape_format, buffer, offset)
+    offset += struct.calcsize(shape_format)
+    return {'element_type': element_type, 'shape': shape, 'quantization': None}, offset
 
 
-def _make_header(total_count, sample_data_record):
-    num_columns = len(sample_data_record)
-    data_headers = bytes().join([_make_data_header(datum_sample) for datum_sample in sample_data_record])
-    header_format = f'II{len(data_headers)}B'
-    return struct.pack(header_format, total_count, num_columns, *data_headers)
+def _make_quantization_table(quantization_table):
+    return bytes().join([
+        _QUANTIZATION_STRUCT.pack(scale, _TYPE_TO_CODE_DICT[original_type])
+        for original_type, scale in quantization_table])
+
 
+def _read_quantization_table(buffer, offset, data_headers):
+    for data_header in data_headers:
+        scale, original_type_code = _QUANTIZATION_STRUCT.unpack_from(buffer, offset)
+        offset += _QUANTIZATION_STRUCT.size
+        original_type = _CODE_TO_TYPE[original_type_code]
+        if original_type != data_header['element_type'] or scale != 1.0:
+            data_header['quantization'] = (original_type, scale)
+    return offset
 
-def _read_header(fp):
-    total_count, num_columns = struct.unpack('II', fp.read(8))
-    data_headers = [_read_data_header(fp) for _ in range(num_columns)]
-    header_size = fp.tell()
-    return header_size, total_count, data_headers
+
+def _make_header(total_count, sample_data_record, layout_code, quantization_table=None):
+    num_columns = len(sample_data_record)
+    data_headers = bytes().join([_make_data_header(datum_sample) for datum_sample in sample_data_record])
+    if quantization_table is None:
+        return _HEADER_STRUCT.pack(total_count, num_columns, layout_code) + data_headers
+    flags = layout_code | _QUANTIZATION_FLAG
+    return _HEADER_STRUCT.pack(total_count, num_columns, flags) + data_headers + _make_quantization_table(quantization_table)
+
+
+def _read_header(buffer):
+    total_count, num_columns, flags = _HEADER_STRUCT.unpack_from(buffer, 0)
+    layout_code = flags & _LAYOUT_CODE_MASK
+    if layout_code not in _LAYOUT_TO_CODE_DICT.values() or flags & ~(_LAYOUT_CODE_MASK | _QUANTIZATION_FLAG):
+        raise Exception('未対応のレイアウトのパックファイルです。')
+    offset = _HEADER_STRUCT.size
+    data_headers = []
+    for _ in range(num_columns):
+        data_header, offset = _read_data_header(buffer, offset)
+        data_headers.append(data_header)
+    if flags & _QUANTIZATION_FLAG:
+        offset = _read_quantization_table(buffer, offset, data_headers)
+    return offset, total_count, layout_code, data_headers
+
+
+def _advise_access_pattern(mapped_file, access_pattern):
+    if access_pattern is None:
+        return
+    if access_pattern not in _ACCESS_PATTERN_TO_MADVISE_NAME:
+        raise Exception('未対応のアクセスパターンが指定されました。')
+    advice = getattr(mmap, _ACCESS_PATTERN_TO_MADVISE_NAME[access_pattern], None)
+    if advice is not None and hasattr(mapped_file, 'madvise'):
+        mapped_file.madvise(advice)
+
+
+def _prefetch(fp, mapped_file):
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+    if hasattr(mmap, 'MADV_WILLNEED') and hasattr(mapped_file, 'madvise'):
+        mapped_file.madvise(mmap.MADV_WILLNEED)
+
+
+def _make_quantization(datum_sample, override):
+    element_type, scale = override if isinstance(override, tuple) else (override, 1.0)
+    try:
+        element_type = numpy.dtype(element_type).type
+    except TypeError:
+        raise Exception('type error')
+    if element_type not in _TYPE_TO_CODE_DICT or not numpy.issubdtype(datum_sample.dtype, numpy.floating):
+        raise Exception('type error')
+    try:
+        scale = float(scale)
+    except (TypeError, ValueError):
+        scale = math.nan
+    if not (math.isfinite(scale) and 0.0 < scale):
+        raise Exception('スケールは正の有限値でなければなりません。')
+    return element_type, scale, datum_sample.dtype.type
+
+
+def _quantize(values, element_type, scale, original_type):
+    if scale == 1.0 and not numpy.issubdtype(element_type, numpy.integer):
+        return numpy.asarray(values).astype(element_type)
+    values = numpy.array(values, dtype=original_type)
+    if scale != 1.0:
+        values /= scale
+    if numpy.issubdtype(element_type, numpy.integer):
+        type_info = numpy.iinfo(element_type)
+        numpy.rint(values, out=values)
+        numpy.clip(values, type_info.min, type_info.max, out=values)
+    return values.astype(element_type)
+
+
+def _restore_datum(datum, column_info):
+    if column_info['quantization'] is None:
+        return datum.copy()
+    original_type, scale = column_info['quantization']
+    if scale == 1.0:
+        return datum.astype(original_type)
+    return numpy.multiply(datum, scale, dtype=original_type)
+
+
+def _to_writable_array(values, dtype):
+    values = numpy.asarray(values)
+    if values.dtype.kind in 'biu' and dtype.kind in 'iu':
+        if 0 < values.size and not numpy.can_cast(values.dtype, dtype, casting='safe'):
+            type_info = numpy.iinfo(dtype)
+            if values.min() < type_info.min or type_info.max < values.max():
+                raise Exception('type error')
+    elif not numpy.can_cast(values.dtype, dtype, casting='same_kind'):
+        raise Exception('type error')
+    return numpy.ascontiguousarray(values, dtype=dtype)
 
 
 def _make_column_format(column):
-    num_elements = numpy.prod(column.shape) if column.shape != () else 1
-    struct_format = _TYPE_TO_STRUCT_FORMAT[column.dtype.type]
-    return num_elements, f'{num_elements}{struct_format}'
+    num_elements = math.prod(column.shape)
+    dtype = numpy.dtype(column.dtype.type)
+    return dtype, num_elements * dtype.itemsize, column.shape
 
 
 def _make_column_info(data_header):
     shape = data_header['shape']
     element_type = data_header['element_type']
-    num_elements = int(numpy.prod(shape))
-    struct_format = _TYPE_TO_STRUCT_FORMAT[element_type]
+    num_elements = math.prod(shape)
     byte_length = num_elements * _TYPE_TO_NBYTES_DICT[element_type]
     is_scalar = (len(shape) == 1 and shape[0] == 1)
     return {
-        'element_type': element_type,
-        'shape': shape,
-        'num_elements': num_elements,
-        'struct_format': f'{num_elements}{struct_format}',
+        'datum_dtype': numpy.dtype(element_type) if is_scalar else numpy.dtype((element_type, shape)),
         'byte_length': byte_length,
-        'is_scalar': is_scalar
+        'quantization': data_header['quantization']
     }
 
 
+def _map_columns(mapped_file, column_info, header_size, total_count, layout_code):
+    if layout_code == _LAYOUT_TO_CODE_DICT['column']:
+        columns = []
+        offset = header_size
+        for colmun_info in column_info:
+            columns.append(numpy.ndarray(
+                shape=(total_count,), dtype=colmun_info['datum_dtype'], buffer=mapped_file, offset=offset))
+            offset += colmun_info['byte_length'] * total_count
+        return columns
+    record_dtype = numpy.dtype([(f'c{i}', colmun_info['datum_dtype']) for i, colmun_info in enumerate(column_info)])
+    records = numpy.ndarray(shape=(total_count,), dtype=record_dtype, buffer=mapped_file, offset=header_size)
+    return [records[f'c{i}'] for i in range(len(column_info))]
+
+
 class Packer:
     """ Packerクラス
 
     ファイルに対してデータレコードを順次書き込む機能を提供します。
     """
-    def __init__(self, packfile_path: str, *sample_data_record):
+    def __init__(self, packfile_path: str, *sample_data_record, layout: str = 'record', dtype_override: dict = None):
         """コンストラクタ
 
         パックファイル名とパック対象のデータ構造をサンプルで指定してパックファイルを作成します。
         既存ファイルが存在する場合は内容を消去して新規に作成します。
         そのため、既存ファイルに対する追記はできません。
 
+        layoutに'column'を指定するとカラムごとにデータを連続して配置します。
+        バッチ単位の読み込みが連続領域の読み込みになる代わりに、パック中はカラムごとの一時ファイルを使用します。
+
+        dtype_overrideにカラムのインデックスと型を指定すると、浮動小数点数のカラムをその型に変換して保存します。
+        型の代わりに(型, スケール)のタプルを指定すると、値をスケールで割って丸めた値を保存します。
+        Loaderは読み込み時に元の型に戻し、スケールを掛けた値を返します。
+
         :arg str packfile_path: 作成するパックファイル名
         :arg * sample_data_record: パック対象のデータフォーマットを指定するためのデータサンプル(可変長引数)
+        :arg str layout: データの配置('record' または 'column')
+        :arg dict dtype_override: カラムのインデックスから保存時の型(または(型, スケール))への辞書
         """
 
+        self.__fp = None
         if type(sample_data_record) != tuple:
             raise Exception('type error')
         for datum_sample in sample_data_record:
-            if type(datum_sample) not in _ACCEPTABLE_DATA_TYPES:
+            if not _is_acceptable_datum(datum_sample):
                 raise Exception('type error')
-        self.__fp = open(packfile_path, 'wb')
-        self.__total_count = 0
-        self.__column_formats = [_make_column_format(column) for column in sample_data_record]
-        self.__fp.write(_make_header(self.__total_count, sample_data_record))
-        self.__num_colmuns = len(sample_data_record)
+        if _MAX_NUM_COLUMNS < len(sample_data_record):
+            raise Exception(f'カラム数は{_MAX_NUM_COLUMNS}以下でなければなりません。')
+        if layout not in _LAYOUT_TO_CODE_DICT:
+            raise Exception('未対応のレイアウトが指定されました。')
+        dtype_override = {} if dtype_override is None else dtype_override
+        if not set(dtype_override).issubset(range(len(sample_data_record))):
+            raise Exception('存在しないカラムのインデックスが指定されました。')
+        self.__quantizations = [
+            _make_quantization(datum_sample, dtype_override[i]) if i in dtype_override else None
+            for i, datum_sample in enumerate(sample_data_record)]
+        quantization_table = [
+            (datum_sample.dtype.type, 1.0 if quantization is None else quantization[1])
+            for datum_sample, quantization in zip(sample_data_record, self.__quantizations)]
+        sample_data_record = tuple([
+            datum_sample if quantization is None else datum_sample.astype(quantization[0])
+            for datum_sample, quantization in zip(sample_data_record, self.__quantizations)])
+        self.__buffer_files = []
+        self.__fp = open(packfile_path, 'wb', buffering=_WRITE_BUFFER_SIZE)
+        try:
+            self.__is_column_layout = layout == 'column'
+            if self.__is_column_layout:
+                temporary_dir = os.path.dirname(os.path.abspath(packfile_path))
+                for _ in sample_data_record:
+                    self.__buffer_files.append(tempfile.TemporaryFile(dir=temporary_dir))
+            else:
+                self.__buffer_files.append(self.__fp)
+            self.__buffers = [bytearray() for _ in self.__buffer_files]
+            self.__total_count = 0
+            self.__column_formats = [_make_column_format(column) for column in sample_data_record]
+            self.__record_dtype = numpy.dtype([
+                (f'c{i}', dtype, shape) for i, (dtype, _, shape) in enumerate(self.__column_formats)])
+            self.__fp.write(_make_header(
+                self.__total_count, sample_data_record, _LAYOUT_TO_CODE_DICT[layout],
+                quantization_table if dtype_override else None))
+            self.__num_colmuns = len(sample_data_record)
+        except BaseException:
+            for buffer_file in self.__buffer_files:
+                buffer_file.close()
+            self.__fp.close()
+            self.__fp = None
+            os.remove(packfile_path)
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __del__(self):
+        if self.__fp is not None:
+            warnings.warn('Packerがclose()されずに破棄されました。', ResourceWarning)
+            self.close()
+
+    def close(self):
+        """ パックファイルをクローズします
+
+        バッファに残っているデータレコードを書き込み、レコード数をヘッダに記録してパックファイルを閉じます。
+        with文で使用した場合はブロックを抜ける際に呼び出されます。
+        """
+        if self.__fp is None:
+            return
+        self.__flush()
+        if self.__is_column_layout:
+            for buffer_file in self.__buffer_files:
+                buffer_file.seek(0, os.SEEK_SET)
+                shutil.copyfileobj(buffer_file, self.__fp, _WRITE_BUFFER_SIZE)
+                buffer_file.close()
         self.__fp.seek(0, os.SEEK_SET)
-        self.__fp.write(struct.pack('I', self.__total_count))
+        self.__fp.write(_TOTAL_COUNT_STRUCT.pack(self.__total_count))
         self.__fp.close()
+        self.__fp = None
+
+    def __check_not_closed(self):
+        if self.__fp is None:
+            raise Exception('クローズ済みのパックファイルです。')
+
+    def __flush(self):
+        for buffer, buffer_file in zip(self.__buffers, self.__buffer_files):
+            if buffer:
+                buffer_file.write(buffer)
+                buffer.clear()
 
     def pack(self, *data_record):
         """ 指定したデータレコードをパックします
@@ -146,13 +333,60 @@ class Packer:
 
         :arg * data_record: パック対象のデータレコード(コンストラクタで指定したサンプルと同じ構造でなければならない)
         """
+        self.__check_not_closed()
         if self.__num_colmuns != len(data_record):
             raise Exception('カラム数が合っていません。')
-        for column, expected_column_format in zip(data_record, self.__column_formats):
-            is_array = type(column) == numpy.ndarray
-            writable_values = column.reshape(expected_column_format[0]).tolist() if is_array else (column, )
-            self.__fp.write(struct.pack(expected_column_format[1], *writable_values))
+        serialized_columns = []
+        for column, (expected_dtype, expected_nbytes, _), quantization in zip(
+                data_record, self.__column_formats, self.__quantizations):
+            if quantization is not None:
+                column = _quantize(column, *quantization)
+            writable_values = _to_writable_array(column, expected_dtype)
+            if writable_values.nbytes != expected_nbytes:
+                raise Exception('データサイズが合っていません。')
+            serialized_columns.append(writable_values.tobytes())
+        if self.__is_column_layout:
+            for buffer, serialized_column in zip(self.__buffers, serialized_columns):
+                buffer += serialized_column
+        else:
+            self.__buffers[0] += bytes().join(serialized_columns)
         self.__total_count += 1
+        if _WRITE_BUFFER_SIZE <= sum([len(buffer) for buffer in self.__buffers]):
+            self.__flush()
+        return None
+
+    def pack_many(self, *data_columns):
+        """ 複数のデータレコードをまとめてパックします
+
+        カラムごとに先頭の次元でレコードを並べた配列を任意長引数で指定し、まとめてパックファイルに追記で保存します。
+        pack()をレコード数だけ呼び出した場合と同じ内容になります。
+
+        :arg * data_columns: カラムごとのデータ(先頭の次元がレコード数で、以降はコンストラクタで指定したサンプルと同じ構造でなければならない)
+        """
+        self.__check_not_closed()
+        if self.__num_colmuns != len(data_columns):
+            raise Exception('カラム数が合っていません。')
+        data_columns = [
+            numpy.asarray(column) if quantization is None else _quantize(column, *quantization)
+            for column, quantization in zip(data_columns, self.__quantizations)]
+        n = len(data_columns[0]) if data_columns[0].shape != () else 0
+        writable_columns = []
+        for column, (expected_dtype, expected_nbytes, expected_shape) in zip(data_columns, self.__column_formats):
+            if column.shape == () or len(column) != n:
+                raise Exception('レコード数が合っていません。')
+            if column.size * expected_dtype.itemsize != n * expected_nbytes:
+                raise Exception('データサイズが合っていません。')
+            writable_columns.append(_to_writable_array(column, expected_dtype).reshape(n, *expected_shape))
+        self.__flush()
+        if self.__is_column_layout:
+            for buffer_file, writable_column in zip(self.__buffer_files, writable_columns):
+                buffer_file.write(writable_column)
+        else:
+            records = numpy.empty(n, dtype=self.__record_dtype)
+            for i, writable_column in enumerate(writable_columns):
+                records[f'c{i}'] = writable_column
+            self.__fp.write(records)
+        self.__total_count += n
         return None
 
 
@@ -161,26 +395,83 @@ class Loader:
 
     パックファイルに対して指定したインデックス値のデータレコードを読み込む機能を提供します。
     """
-    def __init__(self, packfile_path: str):
+    def __init__(self, packfile_path: str, access_pattern: str = None, prefetch: bool = False):
         """ コンストラクタ
 
         パックファイル名を指定して既存のパックファイルを開きます。
         データ構造はパックファイル内に記録されているデータ構造になります。
         開いたパックファイルに対してはランダムアクセスでデータレコードを読み込むことができます。
+        パックファイルはメモリマップして読み込み、ファイル位置を共有しないため複数のスレッドから同時にloadできます。
 
         :arg str packfile_path: 開くパックファイル名
+        :arg str access_pattern: 想定するアクセスパターン('random' または 'sequential')。OSへのヒントとして使用します
+        :arg bool prefetch: Trueの場合、パックファイル全体の先読みをOSに要求します
         """
 
-        self.__fp = open(packfile_path, 'rb')
-        header_size, total_count, data_headers = _read_header(self.__fp)
+        self.__mmap = None
+        self.__packfile_path = packfile_path
+        self.__access_pattern = access_pattern
+        self.__prefetch = prefetch
+        with open(packfile_path, 'rb') as fp:
+            self.__map_file(fp)
+        header_size, total_count, layout_code, data_headers = _read_header(self.__mmap)
         self.__header_size = header_size
         self.__total_count = total_count
+        self.__layout_code = layout_code
         self.__column_info = [_make_column_info(data_header) for data_header in data_headers]
-        self.__block_size = sum([colmun_info['byte_length'] for colmun_info in self.__column_info])
-        self.__block_format = ''.join([colmun_info['struct_format'] for colmun_info in self.__column_info])
+        self.__columns = _map_columns(self.__mmap, self.__column_info, header_size, total_count, layout_code)
+
+    def __map_file(self, fp):
+        self.__mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        _advise_access_pattern(self.__mmap, self.__access_pattern)
+        if self.__prefetch:
+            _prefetch(fp, self.__mmap)
+
+    def __getstate__(self):
+        return {
+            'packfile_path': self.__packfile_path,
+            'access_pattern': self.__access_pattern,
+            'prefetch': self.__prefetch,
+            'header_size': self.__header_size,
+            'total_count': self.__total_count,
+            'layout_code': self.__layout_code,
+            'column_info': self.__column_info
+        }
+
+    def __setstate__(self, state):
+        self.__mmap = None
+        self.__packfile_path = state['packfile_path']
+        self.__access_pattern = state['access_pattern']
+        self.__prefetch = state['prefetch']
+        self.__header_size = state['header_size']
+        self.__total_count = state['total_count']
+        self.__layout_code = state['layout_code']
+        self.__column_info = state['column_info']
+        with open(self.__packfile_path, 'rb') as fp:
+            self.__map_file(fp)
+        self.__columns = _map_columns(
+            self.__mmap, self.__column_info, self.__header_size, self.__total_count, self.__layout_code)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __del__(self):
-        self.__fp.close()
+        self.close()
+
+    def close(self):
+        """パックファイルをクローズします"""
+        if self.__mmap is None:
+            return
+        self.__columns = None
+        self.__mmap.close()
+        self.__mmap = None
+
+    def __check_not_closed(self):
+        if self.__mmap is None:
+            raise Exception('クローズ済みのパックファイルです。')
 
     def count(self):
         """パックファイルが含むレコード数"""
@@ -196,21 +487,32 @@ class Loader:
 
         arg: int index: 読み込み対象のデータレコードのインデックス値
         """
+        self.__check_not_closed()
         if self.__total_count <= index:
             raise Exception("存在しないデータのインデックスが指定されました。")
-        self.__fp.seek(self.__header_size + self.__block_size * index, os.SEEK_SET)
-        values = struct.unpack(self.__block_format, self.__fp.read(self.__block_size))
-        data_record = []
-        head_index = 0
-        for column_info in self.__column_info:
-            tail_index = column_info['num_elements']
-            datum = values[head_index:tail_index]
-            if column_info['is_scalar']:
-                datum = column_info['element_type'](datum[0])
-            else:
-                datum = numpy.array(datum).astype(column_info['element_type']).reshape(*(column_info['shape']))
-            data_record.append(datum)
-        return tuple(data_record)
+        return tuple([
+            _restore_datum(column[index], column_info)
+            for column, column_info in zip(self.__columns, self.__column_info)])
+
+    def load_range(self, head_index: int, tail_index: int, step_size: int = 1):
+        """パックファイルから指定した範囲のデータレコードをカラムごとにまとめて読み込む
+
+        range(head_index, tail_index, step_size)のデータレコードを読み込み、
+        カラムごとに先頭の次元がレコード数の配列にまとめて返します。
+        tail_indexがレコード数を超える場合はレコード数までを読み込みます。
+
+        arg: int head_index: 読み込み対象の先頭のインデックス値
+        arg: int tail_index: 読み込み対象の末尾のインデックス値(このインデックスは含まない)
+        arg: int step_size: 読み込むインデックスの間隔
+        """
+        self.__check_not_closed()
+        if head_index < 0 or self.__total_count <= head_index:
+            raise Exception("存在しないデータのインデックスが指定されました。")
+        if step_size < 1:
+            raise Exception("インデックスの間隔は1以上でなければなりません。")
+        return tuple([
+            _restore_datum(column[head_index:tail_index:step_size], column_info)
+            for column, column_info in zip(self.__columns, self.__column_info)])
 
 
 class BatchLoader:
@@ -218,55 +520,108 @@ class BatchLoader:
 
     指定したバッチサイズ単位でデータレコードをロードするイテレータを提供します。
     """
-    def __init__(self, packfile_path: str, batch_size: int, down_samples: int = None):
+    def __init__(self, packfile_path: str, batch_size: int, down_samples: int = None, prefetch: int = 0):
         """ コンストラクタ
 
         パックファイル名を指定して既存のパックファイルを開きます。
         データ構造はパックファイル内に記録されているデータ構造になります。
         インスタンスはbatch_sizeで指定したレコード数単位でデータを読み込むイテレータを提供します。
+        prefetchに1以上を指定すると、その数だけ先のバッチをバックグラウンドのスレッドで読み込んでおきます。
 
         :arg str packfile_path: 開くパックファイル名
         :arg int batch_size: バッチサイズ
         :arg down_samples: データレコードを間引く単位
+        :arg int prefetch: 先読みするバッチ数
         """
-        self.__loader = Loader(packfile_path)
+        self.__loader = None
+        self.__executor = None
+        self.__loader = Loader(packfile_path, access_pattern='sequential')
         self.__batch_size = batch_size
-        self.__count = self.__loader.count()
         self.__times = 0
-        self.__down_samples = down_samples
+        step_size = down_samples if down_samples is not None else 1
+        self.__indices = range(0, self.__loader.count(), step_size)
+        self.__prefetch = prefetch
+        self.__start_prefetcher()
+
+    def __start_prefetcher(self):
+        self.__pending_batches = collections.deque()
+        self.__scheduled_times = 0
+        if 0 < self.__prefetch:
+            self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.__prefetch)
+
+    def __getstate__(self):
+        return {
+            'loader': self.__loader,
+            'batch_size': self.__batch_size,
+            'indices': self.__indices,
+            'prefetch': self.__prefetch
+        }
+
+    def __setstate__(self, state):
+        self.__loader = state['loader']
+        self.__executor = None
+        self.__batch_size = state['batch_size']
+        self.__times = 0
+        self.__indices = state['indices']
+        self.__prefetch = state['prefetch']
+        self.__start_prefetcher()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __del__(self):
-        del self.__loader
+        self.close()
+
+    def close(self):
+        """パックファイルをクローズします"""
+        if self.__executor is not None:
+            self.__cancel_pending_batches()
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
+        if self.__loader is not None:
+            self.__loader.close()
+            self.__loader = None
 
     def __iter__(self):
         self.__times = 0
+        if self.__executor is not None:
+            self.__cancel_pending_batches()
+            self.__scheduled_times = 0
         return self
 
     def __len__(self):
-        count = self.__count // self.__down_samples if self.__down_samples is not None else self.__count
-        return (count + self.__batch_size - 1) // self.__batch_size
+        return (len(self.__indices) + self.__batch_size - 1) // self.__batch_size
 
     def __next__(self):
-        step_size = self.__down_samples if self.__down_samples is not None else 1
-
-        head_index = self.__times * self.__batch_size * step_size
-        tail_index = (self.__times + 1) * self.__batch_size * step_size
-        if self.__count <= head_index:
+        if self.__loader is None:
+            raise Exception('クローズ済みのパックファイルです。')
+        if self.__executor is None:
+            batches = self.__load_batch(self.__times)
+        else:
+            self.__schedule_batches()
+            batches = self.__pending_batches.popleft().result() if self.__pending_batches else None
+            self.__schedule_batches()
+        if batches is None:
             raise StopIteration()
-        tail_index = min(tail_index, self.__count)
-        records = [self.__loader.load(index) for index in range(head_index, tail_index, step_size)]
-        n = len(records)
-        num_column = len(records[0])
-
-        batches = []
-        for column_i in range(num_column):
-            shape = records[0][column_i].shape
-            if len(shape) == 1 and shape[0] == 1:
-                batch = numpy.array([record[column_i] for record in records])
-            else:
-                batch = numpy.zeros(shape=(n, *shape))
-                for i in range(n):
-                    batch[i] = records[i][column_i]
-            batches.append(batch)
         self.__times += 1
-        return tuple(batches)
+        return batches
+
+    def __load_batch(self, times):
+        batch_indices = self.__indices[times * self.__batch_size:(times + 1) * self.__batch_size]
+        if len(batch_indices) == 0:
+            return None
+        return self.__loader.load_range(batch_indices.start, batch_indices.stop, batch_indices.step)
+
+    def __schedule_batches(self):
+        while len(self.__pending_batches) < self.__prefetch and self.__scheduled_times < len(self):
+            self.__pending_batches.append(self.__executor.submit(self.__load_batch, self.__scheduled_times))
+            self.__scheduled_times += 1
+
+    def __cancel_pending_batches(self):
+        for pending_batch in self.__pending_batches:
+            pending_batch.cancel()
+        concurrent.futures.wait(self.__pending_batches)
+        self.__pending_batches.clear()